@@ -3,6 +3,8 @@ Working with 1C:Enterprise
 """
 import os
 import time
+import uuid
+import threading
 import subprocess as sub
 from psutil import process_iter as ps
 import logger as L
@@ -18,39 +20,73 @@ class OneCClass():
             logger,
             version,
             path='C:\\Program Files (x86)\\1cv8\\',
-            server_name='localhost'):
+            server_name='localhost',
+            rac_timeout=60,
+            restore_timeout=None):
         """
         Params:
             - version: version of 1C:Enterprise to work with
             - path: path to 1C:Enterprise main catalog
             - server_name: name of 1C:Enterprise cluster
+            - rac_timeout: timeout (sec) of a single rac command
+            - restore_timeout: timeout (sec) of restoring the infobase from DT file. None - wait forever
         """
         self.path = os.path.join(path, version, 'bin')
         os.chdir(self.path)
         self.server_name = server_name
+        self.rac_timeout = rac_timeout
+        self.restore_timeout = restore_timeout
         self._logger = logger
+        #self.infobases is never changed in place, but replaced under this lock
+        self._infobases_lock = threading.Lock()
         #Check if ras is running. Run it if necessary
-        self._logger.log(['Checking if RAS is running...'])
-        if 'ras.exe' not in [p.name() for p in ps()]:
-            #Ras is not found. Run it now
-            self._run_command('RAS is not running. Starting RAS', 'ras.exe cluster', service=True)
+        #RAS on a remote server is expected to be already running
+        if self.server_name == 'localhost':
+            self._logger.log(['Checking if RAS is running...'])
+            if 'ras.exe' not in [p.name() for p in ps()]:
+                #Ras is not found. Run it now
+                self._run_command('RAS is not running. Starting RAS', 'ras.exe cluster', service=True)
         #Get cluster GUID
-        output = self._run_command('Getting the cluster GUID:', 'rac.exe cluster list')
+        output = self._run_command(
+            'Getting the cluster GUID:',
+            self._rac('rac.exe cluster list'),
+            timeout=self.rac_timeout)
+        self._cluster_guid = None
         for row in output:
             if row.startswith('cluster'):
                 self._cluster_guid = row[32:]
+        if self._cluster_guid is None:
+            self._logger.log(['No cluster is found on {}'.format(self.server_name)])
+            raise ChildProcessError('No cluster is found on {}'.format(self.server_name))
         self._logger.log(['Cluster GUID is {}'.format(self._cluster_guid)])
         #Get the list of infobases
-        output = self._run_command('Getting the list of infobases', 'rac infobase summary list --cluster={}'.format(self._cluster_guid))
-        self._logger.log(['Infobases in cluster {}:'.format(self._cluster_guid)])
-        self.infobases = {}
-        for row in output:
-            if row.startswith('infobase'):
-                infobase = row[11:]
-            elif row.startswith('name'):
-                name = row[11:]
-                self.infobases[name] = infobase
-                self._logger.log(['{}: {}'.format(name, infobase)])
+        self.refresh_infobases()
+
+    def refresh_infobases(self, log=True):
+        """
+        Re-read the list of cluster infobases into self.infobases ({name: GUID})
+        log: log the command and the list of infobases
+        """
+        #Hold the lock while reading, so an infobase created meanwhile is not lost
+        with self._infobases_lock:
+            output = self._run_command(
+                'Getting the list of infobases',
+                self._rac('rac infobase summary list --cluster={}'.format(self._cluster_guid)),
+                timeout=self.rac_timeout,
+                log=log)
+            if log:
+                self._logger.log(['Infobases in cluster {}:'.format(self._cluster_guid)])
+            infobases = {}
+            for row in output:
+                if row.startswith('infobase'):
+                    infobase = row[11:]
+                elif row.startswith('name'):
+                    name = row[11:]
+                    infobases[name] = infobase
+                    if log:
+                        self._logger.log(['{}: {}'.format(name, infobase)])
+            #Replace the dict at once, so other threads never see it half-filled
+            self.infobases = infobases
 
     def create_infobase(self, ibname, dbms, locale=''):
         """
@@ -77,8 +113,13 @@ class OneCClass():
             db_name=ibname)
         if locale != '':
             command = command + ' --locale={}'.format(locale)
-        output = self._run_command('Creating {} infobase:'.format(ibname), command)
-        infobase_guid = output[11:].decode('utf-8')            #res format is "infobase : XXXXXXXX"
+        with self._infobases_lock:
+            output = self._run_command('Creating {} infobase:'.format(ibname), self._rac(command), timeout=self.rac_timeout)
+            infobase_guid = output[0][11:]            #res format is "infobase : XXXXXXXX"
+            #Replace the dict with a copy, so other threads iterating it are not affected
+            infobases = dict(self.infobases)
+            infobases[ibname] = infobase_guid
+            self.infobases = infobases
         return infobase_guid
 
     def publish_infobase(
@@ -129,12 +170,12 @@ class OneCClass():
             cluster_guid=self._cluster_guid,
             ib_guid=ib_guid
         )
-        command1 = self._add_user_credentials(command1, 'rac', username, pwd)
+        command1 = self._add_user_credentials(self._rac(command1), 'rac', username, pwd)
         #Cycle until all connections are deleted of timeout is over
         start_time = time.time()
         _continue = True
         while _continue:
-            output = self._run_command('Getting the list of {} infobase connections:'.format(ibname), command1)
+            output = self._run_command('Getting the list of {} infobase connections:'.format(ibname), command1, timeout=self.rac_timeout)
             if output == ['']:
                 self._logger.log(['No open connections found'])
                 break
@@ -159,7 +200,7 @@ class OneCClass():
                         process_guid=process_guid,
                         connection_guid=connection_guid
                     )
-                    command2 = self._add_user_credentials(command2, 'rac', username, pwd)
+                    command2 = self._add_user_credentials(self._rac(command2), 'rac', username, pwd)
                     try:
                         self._run_command('Closing a connection:', command2, timeout=20)
                     except Exception as exc:
@@ -188,8 +229,8 @@ class OneCClass():
             cluster_guid=self._cluster_guid,
             ib_guid=ib_guid
         )
-        command1 = self._add_user_credentials(command1, 'rac', username, pwd)
-        output = self._run_command('Getting the list of {} infobase connections:'.format(ibname), command1)
+        command1 = self._add_user_credentials(self._rac(command1), 'rac', username, pwd)
+        output = self._run_command('Getting the list of {} infobase connections:'.format(ibname), command1, timeout=self.rac_timeout)
         if output == ['']:
             self._logger.log(['No open connections found'])
             return
@@ -214,19 +255,57 @@ class OneCClass():
                     process_guid=process_guid,
                     connection_guid=connection_guid
                 )
-                command2 = self._add_user_credentials(command2, 'rac', username, pwd)
+                command2 = self._add_user_credentials(self._rac(command2), 'rac', username, pwd)
                 try:
                     self._run_command('Closing a connection:', command2, timeout=20)
                 except Exception as exc:
                     self._logger.log(['Failed closing connection: {}'.format(str(exc))])
 
-    def ib_set_new_sessions_lock(self, ibname, mode, username, pwd):
+    def get_sessions(self, ibname='', log=True):
+        """
+        Get the list of cluster sessions
+        If ibname is specified, only the sessions of this infobase are returned
+        log: log the command and its result
+        Returns the list of dicts (one dict per session, keys are rac field names)
+        """
+        command = 'rac session list --cluster={cluster_guid}'.format(cluster_guid=self._cluster_guid)
+        if ibname != '':
+            command = command + ' --infobase={}'.format(self._get_ib_guid(ibname))
+        output = self._run_command(
+            'Getting the list of sessions:',
+            self._rac(command),
+            timeout=self.rac_timeout,
+            log=log)
+        return self._parse_rac_output(output)
+
+    def get_connections(self, ibname='', log=True):
+        """
+        Get the list of cluster connections
+        If ibname is specified, only the connections of this infobase are returned
+        log: log the command and its result
+        Returns the list of dicts (one dict per connection, keys are rac field names)
+        """
+        command = 'rac connection list --cluster={cluster_guid}'.format(cluster_guid=self._cluster_guid)
+        if ibname != '':
+            command = command + ' --infobase={}'.format(self._get_ib_guid(ibname))
+        output = self._run_command(
+            'Getting the list of connections:',
+            self._rac(command),
+            timeout=self.rac_timeout,
+            log=log)
+        return self._parse_rac_output(output)
+
+    def ib_set_new_sessions_lock(self, ibname, mode, username, pwd, permission_code=''):
         """
         Block/unblock the new sessions creation for the infobase
+        permission_code: code allowing to start a session despite the lock (/UC command line parameter)
         """
         if not self._check_value('ib_set_new_sessions_lock procedure Mode parameter', mode, ['on', 'off']):
             return
-        self._ib_option_set(ibname, option='sessions-deny', value=mode, username=username, pwd=pwd)
+        options = {'sessions-deny': mode}
+        if permission_code != '':
+            options['permission-code'] = permission_code
+        self._ib_option_set(ibname, options=options, username=username, pwd=pwd)
 
     def ib_set_sch_jobs_lock(self, ibname, mode, username, pwd):
         """
@@ -234,52 +313,66 @@ class OneCClass():
         """
         if not self._check_value('ib_set_sch_jobs_lock procedure Mode parameter', mode, ['on', 'off']):
             return
-        self._ib_option_set(ibname, option='scheduled-jobs-deny', value=mode, username=username, pwd=pwd)
+        self._ib_option_set(ibname, options={'scheduled-jobs-deny': mode}, username=username, pwd=pwd)
 
     def restore_ib(self, ibname, file_name, username='', pwd=''):
         """
         Restore the infobase from DT file
+        New sessions are denied during the restore. DESIGNER passes the lock with a one-time permission code
         """
+        permission_code = uuid.uuid4().hex[:8]
         #Lock new sessions and scheduled jobs
-        self.ib_set_new_sessions_lock(ibname, mode='on', username=username, pwd=pwd)
-        self.ib_set_sch_jobs_lock(ibname, mode='on', username=username, pwd=pwd)
-        #Disconnect all the users from the infobase
-        self.disconnect_ib_users(ibname, username=username, pwd=pwd)
-        #Restore the infobase
-        command = '{path}\\1cv8.exe DESIGNER' + \
-            ' /S localhost\{ibname} /RestoreIB "{file_name}"' + \
-            ' /DisableStartupMessages /DisableStartupDialogs'
-        command = command.format(
-            path=self.path,
-            ibname=ibname,
-            file_name=file_name
-        )
-        command = self._add_user_credentials(command, '1cv8', username, pwd)
-        #Unlock new sessions and scheduled jobs
-        self.ib_set_new_sessions_lock(ibname, mode='off', username=username, pwd=pwd)
-        self.ib_set_sch_jobs_lock(ibname, mode='off', username=username, pwd=pwd)
-        #Restore IB
-        self._run_command(
-            'Restoring {} infobase from DT file'.format(ibname),
-            command)
+        self.ib_set_new_sessions_lock(
+            ibname, mode='on', username=username, pwd=pwd, permission_code=permission_code)
+        try:
+            self.ib_set_sch_jobs_lock(ibname, mode='on', username=username, pwd=pwd)
+            #Disconnect all the users from the infobase
+            self.disconnect_ib_users(ibname, username=username, pwd=pwd)
+            #Restore the infobase
+            command = '{path}\\1cv8.exe DESIGNER' + \
+                ' /S {server_name}\{ibname} /RestoreIB "{file_name}"' + \
+                ' /UC {permission_code}' + \
+                ' /DisableStartupMessages /DisableStartupDialogs'
+            command = command.format(
+                path=self.path,
+                server_name=self.server_name,
+                ibname=ibname,
+                file_name=file_name,
+                permission_code=permission_code
+            )
+            command = self._add_user_credentials(command, '1cv8', username, pwd)
+            #Restore IB
+            self._run_command(
+                'Restoring {} infobase from DT file'.format(ibname),
+                command,
+                timeout=self.restore_timeout)
+        finally:
+            #Unlock new sessions and scheduled jobs even if the restore failed
+            try:
+                self.ib_set_new_sessions_lock(ibname, mode='off', username=username, pwd=pwd)
+            finally:
+                self.ib_set_sch_jobs_lock(ibname, mode='off', username=username, pwd=pwd)
 
-    def _ib_option_set(self, ibname, option, value, username='', pwd=''):
+    def _ib_option_set(self, ibname, options, username='', pwd=''):
         """
-        Set infobase named option to value
+        Set infobase named options to values in one rac call
+        options: dict {option: value}
         """
         ib_guid = self._get_ib_guid(ibname)
         command = 'rac infobase update' + \
             ' --cluster={cluster_guid}' + \
-            ' --infobase={infobase_guid}' + \
-            ' --{option}={value}'
+            ' --infobase={infobase_guid}'
         command = command.format(
             cluster_guid=self._cluster_guid,
-            infobase_guid=ib_guid,
-            option=option,
-            mode=value            
+            infobase_guid=ib_guid
         )
-        command = self._add_user_credentials(command, 'rac', username, pwd)
-        self._run_command('Setting {option} to {value}'.format(option=option, value=value), command)
+        for option, value in options.items():
+            command = command + ' --{option}={value}'.format(option=option, value=value)
+        command = self._add_user_credentials(self._rac(command), 'rac', username, pwd)
+        self._run_command(
+            'Setting {}'.format(', '.join('{} to {}'.format(option, value) for option, value in options.items())),
+            command,
+            timeout=self.rac_timeout)
 
     def _get_ib_guid(self, ibname):
         """
@@ -294,30 +387,61 @@ class OneCClass():
             raise KeyError('Cannot find infobase {}'.format(ibname))
         return ib_guid
     
-    def _run_command(self, descr, command, service=False, timeout=None):
+    def _parse_rac_output(self, output):
+        """
+        Parse rac output into the list of dicts
+        rac prints objects as "name : value" rows separated by empty rows
+        """
+        objects = []
+        obj = {}
+        for row in output:
+            if row.strip() == '':
+                if obj != {}:
+                    objects.append(obj)
+                    obj = {}
+                continue
+            name, _, value = row.partition(':')
+            obj[name.strip()] = value.strip().strip('"')
+        if obj != {}:
+            objects.append(obj)
+        return objects
+
+    def _run_command(self, descr, command, service=False, timeout=None, log=True):
         """
         Run the command using sub.check_call
         Returns the OS result of the command execution
         Puts the output to self.tmp_file, reads it and returns back to caller
         if service == True:
             Do not wait until the command is executed
+        timeout: kill the command if it is not executed in timeout (sec). None - wait forever
+        if log == False:
+            Do not log the command and its result (errors are raised to the caller)
         """
-        self._logger.log([descr, command])
+        if log:
+            self._logger.log([descr, command])
         output = ''
         try:
             proc = sub.Popen(command, stdout=sub.PIPE, stderr=sub.PIPE)
             if not service:
-                proc.wait(timeout)
-                err = proc.stderr.read().decode('utf-8')
+                #Read the pipes while waiting, so a long output doesn't block the command
+                try:
+                    out, err = proc.communicate(timeout=timeout)
+                except sub.TimeoutExpired:
+                    proc.kill()
+                    proc.communicate()
+                    raise
+                err = err.decode('utf-8')
                 if err != '':
                     #Error during command execution
                     raise ChildProcessError('Error {} when {}'.format(err, descr))
                 else:
-                    output = proc.stdout.read().decode('utf-8')
-            self._logger.log(['Success'])
+                    output = out.decode('utf-8')
+            if log:
+                self._logger.log(['Success'])
             return output.split('\r\n')
         except Exception as exc:
-            self._logger.log(['Error:', str(exc)])
+            if log:
+                self._logger.log(['Error:', str(exc)])
             raise exc
 
     def _check_value(self, name, value, valid_values):
@@ -328,6 +452,13 @@ class OneCClass():
         if value not in valid_values:
             self._logger.log(['Invalid {} value. Valid values:'.format(name), valid_values])
             raise ValueError('Invalid {} value. Valid values: {}'.format(name, valid_values))
+        return True
+
+    def _rac(self, command):
+        """
+        Add the RAS address (self.server_name) to rac command
+        """
+        return command + ' {}'.format(self.server_name)
 
     def _add_user_credentials(self, command, tool='rac', username='', pwd=''):
         """
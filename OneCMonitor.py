@@ -0,0 +1,185 @@
+"""
+Monitoring 1C:Enterprise sessions and connections
+"""
+import time
+import threading
+import OneC
+import logger as L
+import credentials as settings
+
+class OneCMonitorClass():
+    """
+    Polls sessions and connections of all cluster infobases
+    Keeps the last snapshot in memory and logs only the differences:
+        - new sessions
+        - closed sessions
+        - sessions running longer than long_session (sec)
+    Uses two rac calls per poll (whole cluster session and connection lists).
+    The list of infobases is re-read only when an unknown infobase GUID shows up
+    Can run in the background (start/stop), other threads read get_counters
+    """
+
+    def __init__(self, logger, onec, long_session=3600):
+        """
+        Params:
+            - onec: OneCClass handle of the cluster to monitor
+            - long_session: session age (sec) to report the session as long-running
+              (the 1C server and this host must use the same time zone, see _parse_time)
+        """
+        self._logger = logger
+        self._onec = onec
+        self.long_session = long_session
+        self.sessions = {}          #Last snapshot: {session GUID: (ibname, session-id, user-name, app-id, started at)}
+        self.counters = {}          #{ibname: {'sessions': N, 'connections': M}}
+        self.snapshot_time = None   #Time of the last successful poll. None - no snapshot yet
+        self._long_reported = set() #Long-running sessions that are already logged
+        self._unknown_guids = set() #Infobase GUIDs not found in the cluster infobase list
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """
+        Take a new snapshot, log the differences with the previous one
+        Returns the differences: {'new': [...], 'closed': [...], 'long': [...]}
+        Each item is (session GUID, snapshot tuple)
+        """
+        session_list = self._onec.get_sessions(log=False)
+        connection_list = self._onec.get_connections(log=False)
+        now = time.time()
+        ib_guids = set(row.get('infobase') for row in session_list + connection_list)
+        #The handle replaces its infobases dict instead of changing it, so the local reference is safe to iterate
+        infobases = self._onec.infobases
+        if ib_guids - set(infobases.values()) - self._unknown_guids:
+            #Infobases were created after the handle had read the list
+            self._onec.refresh_infobases(log=False)
+            infobases = self._onec.infobases
+            #GUIDs still unknown are counted by GUID and do not cause re-reading again
+            self._unknown_guids = ib_guids - set(infobases.values())
+        ib_names = {guid: name for name, guid in infobases.items()}
+        sessions = {}
+        counters = {}
+        for session in session_list:
+            ibname = ib_names.get(session.get('infobase'), session.get('infobase'))
+            sessions[session.get('session')] = (
+                ibname,
+                session.get('session-id'),
+                session.get('user-name'),
+                session.get('app-id'),
+                self._parse_time(session.get('started-at')))
+            counters.setdefault(ibname, {'sessions': 0, 'connections': 0})['sessions'] += 1
+        for connection in connection_list:
+            ibname = ib_names.get(connection.get('infobase'), connection.get('infobase'))
+            counters.setdefault(ibname, {'sessions': 0, 'connections': 0})['connections'] += 1
+        diff = {
+            'new': [(guid, sessions[guid]) for guid in sessions if guid not in self.sessions],
+            'closed': [(guid, self.sessions[guid]) for guid in self.sessions if guid not in sessions],
+            'long': [(guid, sessions[guid]) for guid in sessions
+                     if guid not in self._long_reported
+                     and sessions[guid][4] is not None
+                     and now - sessions[guid][4] > self.long_session]}
+        self._long_reported = set(guid for guid in self._long_reported if guid in sessions)
+        self._long_reported.update(guid for guid, _ in diff['long'])
+        with self._lock:
+            self.sessions = sessions
+            self.counters = counters
+            self.snapshot_time = now
+        self._log_diff(diff)
+        return diff
+
+    def run(self, interval, count=None):
+        """
+        Poll every interval (sec)
+        Stops after count polls (runs forever if count is None) or when stop() is called
+        """
+        self._logger.log(['Monitoring cluster {} every {} sec'.format(self._onec.server_name, interval)])
+        polls = 0
+        while count is None or polls < count:
+            start_time = time.time()
+            try:
+                self.poll()
+            except Exception as exc:
+                #Keep monitoring. The next poll compares with the last successful snapshot
+                self._logger.log(['Failed polling sessions: {}'.format(str(exc))])
+            polls += 1
+            if count is not None and polls >= count:
+                break
+            if self._stop_event.wait(max(0, interval - (time.time() - start_time))):
+                break
+        self._logger.log(['Monitoring cluster {} is stopped'.format(self._onec.server_name)])
+
+    def start(self, interval):
+        """
+        Start polling every interval (sec) in a background (daemon) thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._logger.log(['Monitoring cluster {} is already running'.format(self._onec.server_name)])
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the background polling
+        Waits until the current poll is over (at most timeout sec if specified)
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get_counters(self, ibname, max_age=None):
+        """
+        Get the number of sessions and connections of the infobase from the last snapshot
+        No rac calls are made
+        Returns {'sessions': N, 'connections': M, 'time': snapshot time}
+        Returns None if there is no snapshot yet or it is older than max_age (sec)
+        Returns None if the infobase is not in the cluster (a typo must not look like an idle infobase)
+        """
+        if ibname not in self._onec.infobases:
+            return None
+        with self._lock:
+            if self.snapshot_time is None:
+                return None
+            if max_age is not None and time.time() - self.snapshot_time > max_age:
+                return None
+            counters = dict(self.counters.get(ibname, {'sessions': 0, 'connections': 0}))
+            counters['time'] = self.snapshot_time
+            return counters
+
+    def _log_diff(self, diff):
+        """
+        Log new, closed and long-running sessions
+        Nothing is logged if nothing has changed
+        """
+        messages = []
+        for title, key in [('New session', 'new'), ('Closed session', 'closed'), ('Long-running session', 'long')]:
+            for guid, (ibname, session_id, user_name, app_id, _) in diff[key]:
+                messages.append('{title} {session_id} ({guid}): {ibname}, {user_name}, {app_id}'.format(
+                    title=title,
+                    session_id=session_id,
+                    guid=guid,
+                    ibname=ibname,
+                    user_name=user_name,
+                    app_id=app_id))
+        if messages != []:
+            self._logger.log(messages)
+
+    def _parse_time(self, value):
+        """
+        Convert rac time (2016-05-10T12:00:00) to seconds since the epoch
+        rac prints the 1C server local time, which is read as the local time of this host.
+        Both hosts must use the same time zone, otherwise long-running sessions are misreported
+        Returns None if the value cannot be parsed
+        """
+        try:
+            return time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+        except (TypeError, ValueError):
+            return None
+
+if __name__ == "__main__":
+    LOGGER = L.LoggerClass(mode='2print')
+    ONEC = OneC.OneCClass(logger=LOGGER, version=settings.OneC['version'])
+    MONITOR = OneCMonitorClass(logger=LOGGER, onec=ONEC)
+    MONITOR.run(interval=60)
@@ -0,0 +1,279 @@
+"""
+Working with several 1C:Enterprise clusters at once
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+import OneC
+import logger as L
+import credentials as settings
+
+class OneCMultiClass():
+    """
+    Class holding one OneCClass handle per 1C:Enterprise server
+    Places new infobases on the least loaded cluster
+    Runs infobase operations on all clusters in parallel
+    """
+
+    def __init__(
+            self,
+            logger,
+            version,
+            server_names,
+            path='C:\\Program Files (x86)\\1cv8\\',
+            rac_timeout=60,
+            restore_timeout=4*3600,
+            session_weight=0.1):
+        """
+        Params:
+            - version: version of 1C:Enterprise to work with
+            - server_names: list of 1C:Enterprise cluster names
+            - path: path to 1C:Enterprise main catalog
+            - rac_timeout: timeout (sec) of a single rac command
+            - restore_timeout: timeout (sec) of restoring one infobase from DT file
+            - session_weight: load of one session relative to one infobase (used to place new infobases)
+        Servers that cannot be connected to are logged and left out of self.clusters
+        """
+        self._logger = logger
+        self.session_weight = session_weight
+        self.clusters = {}
+        for server_name in server_names:
+            try:
+                self.clusters[server_name] = OneC.OneCClass(
+                    logger=logger,
+                    version=version,
+                    path=path,
+                    server_name=server_name,
+                    rac_timeout=rac_timeout,
+                    restore_timeout=restore_timeout)
+            except Exception as exc:
+                self._logger.log(['Cluster {} is not available and is skipped: {}'.format(server_name, str(exc))])
+        if self.clusters == {}:
+            self._logger.log(['No cluster is available'])
+
+    def find_cluster(self, ibname, server_name=None):
+        """
+        Find the cluster the infobase is placed in
+        If several clusters have the infobase, the first one is returned.
+        Specify server_name to select the cluster explicitly
+        Returns OneCClass handle or None if the infobase is not found
+        """
+        if server_name is not None:
+            cluster = self.clusters.get(server_name)
+            if cluster is not None and ibname in cluster.infobases:
+                return cluster
+            return None
+        for cluster in self.clusters.values():
+            if ibname in cluster.infobases:
+                return cluster
+        return None
+
+    def get_clusters_load(self):
+        """
+        Get the number of infobases and sessions for each cluster
+        The infobase list is re-read, so infobases created by other scripts are counted too
+        Returns dict {server_name: {'infobases': N, 'sessions': M}}
+        """
+        result = self._run_parallel(
+            'Getting clusters load',
+            [(server_name, '', self._get_cluster_load, {'cluster': cluster})
+             for server_name, cluster in self.clusters.items()])
+        load = {}
+        for task in result['tasks']:
+            if task['error'] is not None:
+                #The cluster cannot be asked. Do not place anything there
+                continue
+            load[task['server_name']] = task['result']
+        return load
+
+    def create_infobase(self, ibname, dbms, locale=''):
+        """
+        Create a new 1C:Enterprise infobase in the least loaded cluster
+        Cluster load = infobases + sessions * self.session_weight. Equal ones are compared by sessions
+        Returns (server_name, infobase GUID)
+        """
+        #Check if the infobase already exists
+        cluster = self.find_cluster(ibname)
+        if cluster is not None:
+            self._logger.log(['Infobase {} is already in the cluster {}'.format(ibname, cluster.server_name)])
+            return cluster.server_name, cluster.infobases[ibname]
+        load = self.get_clusters_load()
+        if load == {}:
+            self._logger.log(['No cluster is available to place infobase {}'.format(ibname)])
+            raise ChildProcessError('No cluster is available to place infobase {}'.format(ibname))
+        server_name = min(
+            load,
+            key=lambda name: (
+                load[name]['infobases'] + load[name]['sessions'] * self.session_weight,
+                load[name]['sessions']))
+        self._logger.log(['Infobase {} is placed in the cluster {} (infobases: {}, sessions: {})'.format(
+            ibname, server_name, load[server_name]['infobases'], load[server_name]['sessions'])])
+        infobase_guid = self.clusters[server_name].create_infobase(ibname, dbms, locale=locale)
+        return server_name, infobase_guid
+
+    def disconnect_ib_users(self, ibnames, username='', pwd=''):
+        """
+        Closing all connections of the infobases in all clusters
+        ibnames: list of infobase names or (server_name, ibname) tuples
+        If ibnames is 'all', all the infobases of all clusters are processed
+        Returns the aggregated result (see _run_parallel)
+        """
+        return self._run_parallel(
+            'Closing infobase connections',
+            self._ib_tasks('disconnect_ib_users', ibnames, {'username': username, 'pwd': pwd}))
+
+    def ib_set_new_sessions_lock(self, mode, ibnames, username='', pwd=''):
+        """
+        Block/unblock the new sessions creation for the infobases in all clusters
+        ibnames: list of infobase names or (server_name, ibname) tuples
+        If ibnames is 'all', all the infobases of all clusters are processed
+        Returns the aggregated result (see _run_parallel)
+        """
+        return self._run_parallel(
+            'Setting new sessions lock to {}'.format(mode),
+            self._ib_tasks('ib_set_new_sessions_lock', ibnames, {'mode': mode, 'username': username, 'pwd': pwd}))
+
+    def ib_set_sch_jobs_lock(self, mode, ibnames, username='', pwd=''):
+        """
+        Block/unblock the new scheduled jobs creation for the infobases in all clusters
+        ibnames: list of infobase names or (server_name, ibname) tuples
+        If ibnames is 'all', all the infobases of all clusters are processed
+        Returns the aggregated result (see _run_parallel)
+        """
+        return self._run_parallel(
+            'Setting scheduled jobs lock to {}'.format(mode),
+            self._ib_tasks('ib_set_sch_jobs_lock', ibnames, {'mode': mode, 'username': username, 'pwd': pwd}))
+
+    def restore_ib(self, files, username='', pwd=''):
+        """
+        Restore the infobases from DT files in all clusters
+        Params:
+            - files: dict {ibname or (server_name, ibname): DT file name}
+        Returns the aggregated result (see _run_parallel)
+        """
+        tasks = []
+        for ib_key, file_name in files.items():
+            tasks = tasks + self._ib_tasks(
+                'restore_ib', [ib_key], {'file_name': file_name, 'username': username, 'pwd': pwd})
+        return self._run_parallel('Restoring infobases from DT files', tasks)
+
+    def _ib_tasks(self, method, ibnames, kwargs):
+        """
+        Build the list of tasks calling OneCClass method for each infobase
+        ibnames: list of infobase names or (server_name, ibname) tuples
+            - ibname: the task is addressed to the first cluster the infobase is placed in
+            - (server_name, ibname): the task is addressed to server_name cluster
+            - 'all': the task is addressed to every infobase of every cluster
+        Unknown infobases get a task raising KeyError, so they are shown in the report
+        """
+        tasks = []
+        if ibnames is None or (isinstance(ibnames, str) and ibnames != 'all'):
+            self._logger.log(['Invalid ibnames value {}. Use a list of infobases or \'all\''.format(ibnames)])
+            raise ValueError('Invalid ibnames value {}. Use a list of infobases or \'all\''.format(ibnames))
+        if ibnames == 'all':
+            for cluster in self.clusters.values():
+                for ibname in cluster.infobases:
+                    tasks.append((cluster.server_name, ibname, getattr(cluster, method), dict(kwargs, ibname=ibname)))
+            return tasks
+        for ib_key in ibnames:
+            if isinstance(ib_key, tuple):
+                server_name, ibname = ib_key
+            else:
+                server_name, ibname = None, ib_key
+            cluster = self.find_cluster(ibname, server_name=server_name)
+            if cluster is None:
+                self._logger.log(['Cannot find infobase {} in cluster {}'.format(ibname, server_name or 'any')])
+                tasks.append((server_name or '', ibname, self._not_found, {'ibname': ibname, 'server_name': server_name}))
+            else:
+                tasks.append((cluster.server_name, ibname, getattr(cluster, method), dict(kwargs, ibname=ibname)))
+        return tasks
+
+    def _get_cluster_load(self, cluster):
+        """
+        Re-read the cluster infobases and count them and the cluster sessions
+        """
+        cluster.refresh_infobases(log=False)
+        return {
+            'infobases': len(cluster.infobases),
+            'sessions': len(cluster.get_sessions())}
+
+    def _not_found(self, ibname, server_name=None):
+        """
+        Task for the infobase that is not placed in the cluster (in any cluster if server_name is None)
+        """
+        raise KeyError('Cannot find infobase {} in cluster {}'.format(ibname, server_name or 'any'))
+
+    def _run_parallel(self, descr, tasks):
+        """
+        Run the tasks, one thread per cluster
+        Tasks of the same cluster are run one after another
+        tasks: list of (server_name, ibname, function, kwargs)
+        Failed tasks do not stop the others. Returns the aggregated result:
+            {'success': True if all tasks succeeded,
+             'duration': total time (sec),
+             'tasks': [{'server_name', 'ibname', 'result', 'error', 'duration'}, ...]}
+        """
+        self._logger.log(['{}: {} task(s) in {} cluster(s)'.format(descr, len(tasks), len(self.clusters))])
+        queues = {}
+        for task in tasks:
+            queues.setdefault(task[0], []).append(task)
+        start_time = time.time()
+        results = []
+        if queues != {}:
+            with ThreadPoolExecutor(max_workers=len(queues)) as executor:
+                for queue_results in executor.map(self._run_queue, queues.values()):
+                    results = results + queue_results
+        result = {
+            'success': all(task['error'] is None for task in results),
+            'duration': time.time() - start_time,
+            'tasks': results}
+        self._log_report(descr, result)
+        return result
+
+    def _run_queue(self, tasks):
+        """
+        Run the tasks of one cluster one after another
+        """
+        results = []
+        for server_name, ibname, function, kwargs in tasks:
+            start_time = time.time()
+            task_result = None
+            error = None
+            try:
+                task_result = function(**kwargs)
+            except Exception as exc:
+                error = exc
+            results.append({
+                'server_name': server_name,
+                'ibname': ibname,
+                'result': task_result,
+                'error': error,
+                'duration': time.time() - start_time})
+        return results
+
+    def _log_report(self, descr, result):
+        """
+        Log the timing report of _run_parallel
+        """
+        messages = ['{} is {} in {:.1f} sec:'.format(
+            descr,
+            'finished' if result['success'] else 'finished with errors',
+            result['duration'])]
+        for task in result['tasks']:
+            messages.append('{server_name} {ibname}: {status} ({duration:.1f} sec)'.format(
+                server_name=task['server_name'],
+                ibname=task['ibname'],
+                status='Success' if task['error'] is None else 'Error: {}'.format(task['error']),
+                duration=task['duration']))
+        self._logger.log(messages)
+
+if __name__ == "__main__":
+    LOGGER = L.LoggerClass(mode='2print')
+    ONEC = OneCMultiClass(
+        logger=LOGGER,
+        version=settings.OneC['version'],
+        server_names=settings.OneC['server_names'])
+    ONEC.restore_ib(
+        files={settings.DemoIB['ibname']: settings.DemoIB['file_name']},
+        username=settings.DemoIB['username'],
+        pwd=settings.DemoIB['pwd']
+    )